@@ -4,15 +4,28 @@ Extração automática de dados clínicos via Gemini → Google Sheets
 """
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 import anthropic
 import gspread
 from google.oauth2.service_account import Credentials
 import json
+import orjson
+import gzip
+import hashlib
+import tempfile
+import zlib
 import re
-from datetime import datetime, date
+from datetime import datetime, date, timezone
 from docx import Document
+from docx.oxml.ns import nsmap, qn
+from lxml import etree
 import pdfplumber
+import pypdfium2 as pdfium
 import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import pandas as pd
 
 # ─── PAGE CONFIG ──────────────────────────────────────────────────────────────
@@ -31,6 +44,16 @@ SHEET_DOENTES = "Doentes"
 SHEET_VISITAS = "Visitas_Análises"
 SHEET_EVENTOS = "Eventos"
 
+# Orçamento de caracteres do PDF de análises enviado ao modelo
+PDF_MAX_CHARS = 120_000
+
+LLM_MODEL = "claude-sonnet-4-5"
+# Incrementar sempre que o EXTRACTION_PROMPT mudar (invalida a cache de extrações)
+PROMPT_VERSION = "2"
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".core_cache")
+# Dados clínicos: as extrações em cache expiram ao fim deste tempo
+CACHE_TTL_S = 7 * 24 * 3600
+
 HEADERS_DOENTES = [
     "N_Processo", "Data_Nascimento", "Idade", "Sexo", "Localidade",
     "Profissao", "Frailty_CFS", "Referenciacao",
@@ -130,9 +153,10 @@ def get_gspread_client():
     )
     return gspread.authorize(creds)
 
-def get_spreadsheet():
+@st.cache_resource(show_spinner=False)
+def get_spreadsheet(spreadsheet_id: str):
     client = get_gspread_client()
-    return client.open_by_key(st.secrets["spreadsheet_id"])
+    return client.open_by_key(spreadsheet_id)
 
 def get_or_create_sheet(spreadsheet, name: str, headers: list):
     try:
@@ -142,40 +166,214 @@ def get_or_create_sheet(spreadsheet, name: str, headers: list):
         ws.append_row(headers)
     return ws
 
-def update_doentes_sheet(ws, n_processo: str, row: list):
-    """Atualiza linha existente ou acrescenta nova."""
-    col_a = ws.col_values(1)          # lista, 0-indexed; posição 0 = cabeçalho
-    if n_processo in col_a:
-        row_idx = col_a.index(n_processo) + 1   # gspread é 1-indexed
-        ws.delete_rows(row_idx)
-        ws.insert_row(row, row_idx)
+@st.cache_resource(show_spinner=False)
+def get_worksheets(spreadsheet_id: str):
+    """(Doentes, Visitas, Eventos) — criadas com cabeçalhos se não existirem."""
+    ss = get_spreadsheet(spreadsheet_id)
+    return (
+        get_or_create_sheet(ss, SHEET_DOENTES, HEADERS_DOENTES),
+        get_or_create_sheet(ss, SHEET_VISITAS, HEADERS_VISITAS),
+        get_or_create_sheet(ss, SHEET_EVENTOS, HEADERS_EVENTOS),
+    )
+
+def reset_sheets_connection():
+    """Esquece cliente, folhas e índice em cache (próxima gravação volta a ligar)."""
+    get_gspread_client.clear()
+    get_spreadsheet.clear()
+    get_worksheets.clear()
+    _doentes_index.clear()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _doentes_index(_ws, sheet_id: int) -> tuple:
+    """(instante da leitura, N_Processo → índice 0-based da linha na folha Doentes)."""
+    index = {}
+    for i, v in enumerate(_ws.col_values(1)[1:], start=1):   # 0 = cabeçalho
+        index.setdefault(v, i)                               # 1.ª ocorrência
+    return time.monotonic(), index
+
+def _doente_row(ws_d, n_processo: str):
+    """Índice 0-based da linha do doente em Doentes, ou None se for novo.
+
+    O índice em cache é partilhado entre sessões e pode estar desatualizado
+    (linhas inseridas, apagadas ou ordenadas à mão no Sheet). Se foi lido
+    nesta chamada, vale tal como está. Caso contrário, um acerto só é aceite
+    se a célula A dessa linha ainda tiver o N_Processo (uma leitura de uma
+    célula), e uma falha ou discrepância relê a coluna A.
+    """
+    started = time.monotonic()
+    loaded_at, index = _doentes_index(ws_d, ws_d.id)
+    row_idx = index.get(n_processo)
+    if loaded_at >= started:
+        return row_idx
+    if row_idx is not None and ws_d.acell(f"A{row_idx + 1}").value == n_processo:
+        return row_idx
+    _doentes_index.clear()
+    return _doentes_index(ws_d, ws_d.id)[1].get(n_processo)
+
+def _warm_sheets(spreadsheet_id: str):
+    # Só as folhas: o índice de Doentes é lido (e validado) na gravação
+    try:
+        get_worksheets(spreadsheet_id)
+    except Exception:
+        pass                             # erros reais aparecem ao guardar
+
+def warm_sheets_in_background():
+    """Abre as folhas numa thread, em paralelo com a extração."""
+    spreadsheet_id = st.secrets.get("spreadsheet_id", "")
+    if not spreadsheet_id:
+        return
+    t = threading.Thread(target=_warm_sheets, args=(spreadsheet_id,), daemon=True)
+    add_script_run_ctx(t)
+    t.start()
+
+def _row_data(row: list) -> dict:
+    """Linha de valores → RowData da API (equivalente a valueInputOption RAW)."""
+    return {"values": [{"userEnteredValue": {"stringValue": str(v)}} for v in row]}
+
+def save_consulta(ss, ws_d, ws_v, n_processo: str, row_d: list, row_v: list):
+    """Atualiza/acrescenta a linha do doente e acrescenta a visita.
+
+    Ambas as escritas seguem num único `batch_update` (aplicado pelo Sheets
+    como um todo ou nada).
+    """
+    row_idx = _doente_row(ws_d, n_processo)
+    if row_idx is not None:
+        req_d = {"updateCells": {
+            "rows": [_row_data(row_d)],
+            "fields": "userEnteredValue",
+            "start": {"sheetId": ws_d.id, "rowIndex": row_idx, "columnIndex": 0},
+        }}
     else:
-        ws.append_row(row)
+        req_d = {"appendCells": {
+            "sheetId": ws_d.id, "rows": [_row_data(row_d)], "fields": "userEnteredValue",
+        }}
+    req_v = {"appendCells": {
+        "sheetId": ws_v.id, "rows": [_row_data(row_v)], "fields": "userEnteredValue",
+    }}
+    ss.batch_update({"requests": [req_d, req_v]})
 
 # ─── PARSERS DE FICHEIRO ──────────────────────────────────────────────────────
+@st.cache_resource
+def _pdfium_lock():
+    """Lock único do processo: o app.py é re-executado a cada run, um global não servia."""
+    return threading.Lock()
+
+_W_P, _W_TBL, _W_TR, _W_TC = qn("w:p"), qn("w:tbl"), qn("w:tr"), qn("w:tc")
+_W_T, _W_BR, _W_TYPE, _W_VAL = qn("w:t"), qn("w:br"), qn("w:type"), qn("w:val")
+_TR_GRID_BEFORE = f"{qn('w:trPr')}/{qn('w:gridBefore')}"
+_TC_GRID_SPAN   = f"{qn('w:tcPr')}/{qn('w:gridSpan')}"
+_TC_VMERGE      = f"{qn('w:tcPr')}/{qn('w:vMerge')}"
+# Só runs filhos directos do parágrafo (ou de hiperligações), como Paragraph.text:
+# caixas de texto (w:txbxContent, em mc:Choice e mc:Fallback) ficam de fora.
+_RUN_CONTENT = etree.XPath(
+    "(w:r | w:hyperlink/w:r)/*[self::w:t or self::w:tab or self::w:ptab"
+    " or self::w:br or self::w:cr or self::w:noBreakHyphen]",
+    namespaces={"w": nsmap["w"]},
+)
+_RUN_CHARS = {qn("w:tab"): "\t", qn("w:ptab"): "\t", qn("w:cr"): "\n", qn("w:noBreakHyphen"): "-"}
+
+def _docx_para_text(p) -> str:
+    """Texto de um <w:p>, lido directamente do XML (sem objetos Paragraph/Run)."""
+    parts = []
+    for el in _RUN_CONTENT(p):
+        tag = el.tag
+        if tag == _W_T:
+            if el.text:
+                parts.append(el.text)
+        elif tag == _W_BR:
+            # Quebras de página/coluna não produzem texto
+            if el.get(_W_TYPE, "textWrapping") == "textWrapping":
+                parts.append("\n")
+        else:
+            parts.append(_RUN_CHARS[tag])
+    return "".join(parts)
+
+def _docx_int(el, path: str, default: int) -> int:
+    found = el.find(path)
+    return int(found.get(_W_VAL)) if found is not None else default
+
+def _docx_table_rows(tbl):
+    """Gera, por linha, o texto de cada célula como em `_Row.cells` do python-docx.
+
+    Uma célula com gridSpan repete-se por cada coluna que ocupa; uma célula de
+    continuação de vMerge repete o texto da célula acima na mesma coluna.
+    """
+    above = {}                           # offset na grelha → texto, linha anterior
+    for tr in tbl.iterchildren(_W_TR):
+        offset = _docx_int(tr, _TR_GRID_BEFORE, 0)
+        row, current = [], {}
+        for tc in tr.iterchildren(_W_TC):
+            span   = _docx_int(tc, _TC_GRID_SPAN, 1)
+            vmerge = tc.find(_TC_VMERGE)
+            if vmerge is not None and vmerge.get(_W_VAL, "continue") == "continue":
+                text = above.get(offset, "")
+            else:
+                text = "\n".join(_docx_para_text(p) for p in tc.iterchildren(_W_P)).strip()
+            current[offset] = text
+            row.extend([text] * span)
+            offset += span
+        above = current
+        yield row
+
 def parse_docx(file_bytes: bytes) -> str:
-    doc = Document(io.BytesIO(file_bytes))
+    body = Document(io.BytesIO(file_bytes)).element.body
     lines = []
-    for para in doc.paragraphs:
-        t = para.text.strip()
+    for p in body.iterchildren(_W_P):
+        t = _docx_para_text(p).strip()
         if t:
             lines.append(t)
     # Incluir texto em tabelas, se existirem
-    for table in doc.tables:
-        for row in table.rows:
-            row_text = " | ".join(c.text.strip() for c in row.cells if c.text.strip())
+    for tbl in body.iterchildren(_W_TBL):
+        for cells in _docx_table_rows(tbl):
+            row_text = " | ".join(c for c in cells if c)
             if row_text:
                 lines.append(row_text)
     return "\n".join(lines)
 
-def parse_pdf(file_bytes: bytes) -> str:
-    text_parts = []
+def _pdfium_page_texts(file_bytes: bytes):
+    """Gera o texto de cada página, por ordem, via pdfium."""
+    with _pdfium_lock():                 # o pdfium não é thread-safe
+        doc = pdfium.PdfDocument(file_bytes)
+        try:
+            for i in range(len(doc)):
+                page = doc[i]
+                textpage = page.get_textpage()
+                yield textpage.get_text_range().replace("\r\n", "\n")
+                textpage.close()
+                page.close()
+        finally:
+            doc.close()
+
+def _pdfplumber_page_texts(file_bytes: bytes):
+    """Gera o texto de cada página, por ordem, via pdfplumber.
+
+    Só é usado quando o pdfium recusa o ficheiro (ver parse_pdf), o que é raro.
+    """
     with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
         for page in pdf.pages:
-            t = page.extract_text()
-            if t:
-                text_parts.append(t)
-    return "\n".join(text_parts).strip()
+            yield page.extract_text() or ""
+            page.close()                 # liberta a cache de objetos da página
+
+def _join_pages(page_texts, max_chars: int) -> str:
+    buf = io.StringIO()
+    for t in page_texts:
+        if t:
+            buf.write(t)
+            buf.write("\n")
+        if buf.tell() > max_chars:
+            break
+    return buf.getvalue()[:max_chars].strip()
+
+def parse_pdf(file_bytes: bytes, max_chars: int = PDF_MAX_CHARS) -> str:
+    """Extrai o texto página a página, parando quando excede `max_chars`.
+
+    Usa o pdfium (várias vezes mais rápido); se este recusar o ficheiro,
+    recorre ao pdfplumber.
+    """
+    try:
+        return _join_pages(_pdfium_page_texts(file_bytes), max_chars)
+    except pdfium.PdfiumError:
+        return _join_pages(_pdfplumber_page_texts(file_bytes), max_chars)
 
 # ─── PROMPT & EXTRAÇÃO LLM ───────────────────────────────────────────────────
 EXTRACTION_PROMPT = """
@@ -209,9 +407,7 @@ REGRAS DE EXTRAÇÃO:
 - Anticoagulante inclui: apixabano, rivaroxabano, dabigatrano, edoxabano, varfarina
 - Beta-bloqueante inclui: carvedilol, bisoprolol, nebivolol, metoprolol, atenolon
 
-TEXTO CLÍNICO:
-{texto}
-
+O texto clínico segue na mensagem do utilizador.
 Responde EXCLUSIVAMENTE com o JSON abaixo preenchido (sem markdown, sem texto extra):
 
 {
@@ -327,31 +523,156 @@ Responde EXCLUSIVAMENTE com o JSON abaixo preenchido (sem markdown, sem texto ex
   }
 }
 """
+# Só esta parte muda entre pedidos; o EXTRACTION_PROMPT vai no system, em cache
+EXTRACTION_USER_TEMPLATE = """TEXTO CLÍNICO:
+{texto}
+"""
+_USER_PREFIX, _USER_SUFFIX = EXTRACTION_USER_TEMPLATE.split("{texto}")
+
+# Cercas de markdown à volta do JSON (```json … ```)
+_FENCE_PREFIX = re.compile(r"^```(?:json)?\s*")
+_FENCE_SUFFIX = re.compile(r"\s*```$")
+
+@st.cache_resource
+def get_llm_client():
+    return anthropic.Anthropic(api_key=st.secrets["gemini_api_key"])
+
 def extract_with_gemini(texto: str) -> dict:
-    client = anthropic.Anthropic(api_key=st.secrets["gemini_api_key"])
-    prompt = EXTRACTION_PROMPT.replace("{texto}", texto)
+    client = get_llm_client()
+    prompt = "".join((_USER_PREFIX, texto, _USER_SUFFIX))
     message = client.messages.create(
-        model="claude-sonnet-4-5",
+        model=LLM_MODEL,
         max_tokens=8192,
+        system=[{
+            "type": "text",
+            "text": EXTRACTION_PROMPT,
+            "cache_control": {"type": "ephemeral"},
+        }],
         messages=[{"role": "user", "content": prompt}]
     )
     raw = message.content[0].text.strip()
-    # Limpar eventual markdown
-    raw = re.sub(r"^```(?:json)?\s*", "", raw)
-    raw = re.sub(r"\s*```$", "", raw)
-    return json.loads(raw)
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # Limpar eventual markdown
+        raw = _FENCE_PREFIX.sub("", raw)
+        raw = _FENCE_SUFFIX.sub("", raw)
+        return orjson.loads(raw)
+
+# ─── CACHE DE EXTRAÇÃO ────────────────────────────────────────────────────────
+class ExtractionCache:
+    """Extrações já feitas, em disco (JSON gzip), indexadas pelo SHA-256 dos ficheiros de entrada."""
+
+    REQUIRED_KEYS = ("doente", "visita")
+
+    def __init__(self, directory: str, ttl_s: int):
+        self.directory = directory
+        self.ttl_s = ttl_s
+
+    def _expired(self, mtime: float) -> bool:
+        return time.time() - mtime > self.ttl_s
+
+    @staticmethod
+    def key(docx_bytes: bytes, pdf_bytes) -> str:
+        # Cada parte leva o comprimento à frente, para que (a, bc) ≠ (ab, c)
+        h = hashlib.sha256()
+        for part in (docx_bytes, pdf_bytes or b"", LLM_MODEL.encode(), PROMPT_VERSION.encode()):
+            h.update(len(part).to_bytes(8, "little"))
+            h.update(part)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json.gz")
+
+    @classmethod
+    def _valid(cls, extracted) -> bool:
+        return isinstance(extracted, dict) and all(k in extracted for k in cls.REQUIRED_KEYS)
+
+    def get(self, key: str):
+        """Devolve a extração guardada, ou None. Entradas inválidas ou expiradas são apagadas."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                if self._expired(os.fstat(f.fileno()).st_mtime):
+                    extracted = None
+                else:
+                    extracted = orjson.loads(gzip.decompress(f.read())).get("extracted")
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, zlib.error, ValueError, AttributeError):
+            extracted = None
+        if not self._valid(extracted):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return extracted
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def put(self, key: str, extracted: dict):
+        if not self._valid(extracted):
+            return
+        payload = {
+            "created_utc":    datetime.now(timezone.utc).isoformat(),
+            "model":          LLM_MODEL,
+            "prompt_version": PROMPT_VERSION,
+            "extracted":      extracted,
+        }
+        tmp = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                # Nível 3: quase toda a compressão (chaves e nulls repetidos) a uma fração do custo
+                f.write(gzip.compress(orjson.dumps(payload), compresslevel=3))
+            os.replace(tmp, self._path(key))
+        except OSError:
+            # A cache é opcional; nunca bloqueia a consulta
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+        self._evict_expired()
+
+    def _evict_expired(self):
+        """Apaga entradas fora do prazo (a pasta só guarda CACHE_TTL_S de gravações)."""
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if self._expired(entry.stat().st_mtime):
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+EXTRACTION_CACHE = ExtractionCache(CACHE_DIR, CACHE_TTL_S)
 
 # ─── HELPERS DE VALOR ──────────────────────────────────────────────────────────
-def sv(val) -> str:
+# type(val) → conversor; type(True) é bool (não int), por isso não há ambiguidade
+_SV = {
+    bool:       lambda v: "Sim" if v else "Não",
+    type(None): lambda v: "",
+    str:        str,
+    int:        str,
+    float:      str,
+}
+
+def sv(val, _t=_SV, _s=str) -> str:
     """safe value → string"""
-    if val is None:
-        return ""
-    if val is True:
-        return "Sim"
-    if val is False:
-        return "Não"
-    return str(val)
+    return _t.get(type(val), _s)(val)
 
+# Chamada uma vez por gravação: não justifica JIT (Numba) — o import e o
+# despacho custariam mais do que a conta. Só faria sentido num cálculo em lote
+# sobre toda a folha Visitas (ex.: CKD-EPI), e apenas nesse kernel.
 def calculate_age(dob_str: str):
     try:
         dob = datetime.strptime(dob_str, "%Y-%m-%d").date()
@@ -361,78 +682,115 @@ def calculate_age(dob_str: str):
         return None
 
 # ─── CONSTRUTORES DE LINHAS PARA O SHEET ─────────────────────────────────────
-def build_doentes_row(n_processo: str, extracted: dict) -> list:
-    d  = extracted["doente"]
-    frcv = d.get("frcv", {})
-    co   = d.get("comorbilidades", {})
-    ic   = d.get("ic", {})
-    drc  = d.get("drc", {})
-    poc  = d.get("pocus", {})
-    med  = d.get("medicacao", {})
-    age  = calculate_age(d.get("data_nascimento") or "")
-
-    def med3(key):
-        m = med.get(key) or {}
-        return [sv(m.get("presente")), sv(m.get("farmaco")), sv(m.get("dose"))]
+# (coluna, caminho no JSON extraído), pela ordem das colunas de cada folha.
+# Doentes: N_Processo, Data_Nascimento e Idade são preenchidos à parte.
+_MED_COLS = (
+    ("RASi", "rasi"), ("MRA", "mra"), ("iSGLT2", "isglt2"), ("GLP1RA", "glp1ra"),
+    ("Estatina", "estatina"), ("Diuretico_ansa", "diuretico_ansa"),
+    ("Diuretico_tiazida", "diuretico_tiazida"), ("Acetazolamida", "acetazolamida"),
+    ("BetaBloqueante", "beta_bloqueante"), ("Antiagregante", "antiagregante"),
+    ("Anticoagulante", "anticoagulante"), ("Ivabradina", "ivabradina"),
+)
+
+_DOENTES_PATHS = (
+    ("Sexo",                  ("doente", "sexo")),
+    ("Localidade",            ("doente", "localidade")),
+    ("Profissao",             ("doente", "profissao")),
+    ("Frailty_CFS",           ("doente", "frailty_cfs")),
+    ("Referenciacao",         ("doente", "referenciacao")),
+    # FRCV
+    ("DM2",                   ("doente", "frcv", "dm2")),
+    ("Tabagismo",             ("doente", "frcv", "tabagismo")),
+    ("HTA",                   ("doente", "frcv", "hta")),
+    ("Dislipidemia",          ("doente", "frcv", "dislipidemia")),
+    ("Obesidade",             ("doente", "frcv", "obesidade")),
+    ("SAOS",                  ("doente", "frcv", "saos")),
+    ("Sedentarismo",          ("doente", "frcv", "sedentarismo")),
+    ("HxFamiliar_DC",         ("doente", "frcv", "hx_familiar_dc")),
+    # Comorbilidades
+    ("DAP",                   ("doente", "comorbilidades", "dap")),
+    ("DPOC",                  ("doente", "comorbilidades", "dpoc")),
+    ("Doenca_hepatica",       ("doente", "comorbilidades", "doenca_hepatica")),
+    ("HBP",                   ("doente", "comorbilidades", "hbp")),
+    ("FA",                    ("doente", "comorbilidades", "fa")),
+    ("Outras_comorbilidades", ("doente", "comorbilidades", "outras")),
+    # IC
+    ("IC_FE_tipo",            ("doente", "ic", "tipo_fe")),
+    ("IC_Etiologia",          ("doente", "ic", "etiologia")),
+    ("IC_FEVE_atual_pct",     ("doente", "ic", "feve_atual")),
+    ("IC_FEVE_trajetoria",    ("doente", "ic", "feve_trajetoria")),
+    # DRC
+    ("DRC_Grau",              ("doente", "drc", "grau")),
+    ("DRC_Albuminuria",       ("doente", "drc", "albuminuria")),
+    ("DRC_Etiologia",         ("doente", "drc", "etiologia")),
+    # Congestão + POCUS
+    ("Fenotipo_congestao",    ("doente", "fenotipo_congestao")),
+    ("POCUS_FE_pct",          ("doente", "pocus", "fe_pct")),
+    ("POCUS_EE_ratio",        ("doente", "pocus", "ee_ratio")),
+    ("POCUS_LinhasB_N",       ("doente", "pocus", "linhas_b_n")),
+    ("POCUS_VCI_mm",          ("doente", "pocus", "vci_mm")),
+    # Medicação (12 classes × 3)
+    *(
+        (col + suffix, ("doente", "medicacao", key, field))
+        for col, key in _MED_COLS
+        for suffix, field in (("", "presente"), ("_farmaco", "farmaco"), ("_dose", "dose"))
+    ),
+)
+
+# Visitas: N_Processo é preenchido à parte.
+_VISITAS_PATHS = (
+    ("Data_consulta", ("visita", "data_consulta")),
+    *((col, ("visita", "analises", key)) for col, key in (
+        ("Ureia", "ureia"), ("Creatinina", "creatinina"), ("Cistatina_C", "cistatina_c"),
+        ("TFGe_CKD_EPI_CrCist", "tfge_ckd_epi_crcist"),
+        ("RACu_mg_g", "racu"), ("RPC_mg_g", "rpc"), ("Na_urinario", "na_urinario"),
+        ("Albumina", "albumina"), ("ALT", "alt"), ("AST", "ast"), ("GGT", "ggt"),
+        ("Bilirrubina_total", "bilirrubina_total"),
+        ("Na", "na"), ("K", "k"), ("Cl", "cl"), ("Ca", "ca"), ("P", "p"), ("Mg", "mg"),
+        ("PTH", "pth"), ("Vit_D", "vit_d"),
+        ("NT_proBNP", "nt_probnp"), ("BNP", "bnp"), ("CA125", "ca125"),
+        ("Hgb", "hgb"), ("Leucocitos", "leucocitos"), ("Plaquetas", "plaquetas"),
+        ("HCO3", "hco3"), ("Ca_ionizado", "ca_ionizado"),
+        ("Sumario_urina", "sumario_urina"),
+    )),
+    *((col, ("visita", "sintomas", key)) for col, key in (
+        ("NYHA", "nyha"), ("CCS", "ccs"), ("Ortopneia", "ortopneia"),
+        ("Bendopneia", "bendopneia"), ("Edemas_MI", "edemas_mi"),
+        ("Claudicacao_intermitente", "claudicacao_intermitente"),
+        ("Palpitacoes", "palpitacoes"),
+    )),
+    *((col, ("visita", "exame_fisico", key)) for col, key in (
+        ("Peso_kg", "peso_kg"), ("Altura_m", "altura_m"), ("IMC", "imc"),
+        ("TA_sist", "ta_sist"), ("TA_diast", "ta_diast"), ("FC", "fc"), ("SpO2", "spo2"),
+    )),
+)
+
+# Uma edição dos cabeçalhos sem acertar as tabelas acima desalinharia as colunas
+assert [col for col, _ in _DOENTES_PATHS] == HEADERS_DOENTES[3:-1], "_DOENTES_PATHS ≠ HEADERS_DOENTES"
+assert [col for col, _ in _VISITAS_PATHS] == HEADERS_VISITAS[1:], "_VISITAS_PATHS ≠ HEADERS_VISITAS"
+
+# Só os caminhos são precisos em runtime
+_DOENTES_GETS = tuple(path for _, path in _DOENTES_PATHS)
+_VISITAS_GETS = tuple(path for _, path in _VISITAS_PATHS)
 
+def _get(obj, path: tuple):
+    """Percorre `path` em dicts encadeados; None se algum nível faltar."""
+    for key in path:
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+def build_doentes_row(n_processo: str, extracted: dict) -> list:
+    dob = extracted["doente"].get("data_nascimento")
     return [
-        n_processo,
-        sv(d.get("data_nascimento")), sv(age),
-        sv(d.get("sexo")), sv(d.get("localidade")),
-        sv(d.get("profissao")), sv(d.get("frailty_cfs")),
-        sv(d.get("referenciacao")),
-        # FRCV
-        sv(frcv.get("dm2")), sv(frcv.get("tabagismo")), sv(frcv.get("hta")),
-        sv(frcv.get("dislipidemia")), sv(frcv.get("obesidade")),
-        sv(frcv.get("saos")), sv(frcv.get("sedentarismo")), sv(frcv.get("hx_familiar_dc")),
-        # Comorbilidades
-        sv(co.get("dap")), sv(co.get("dpoc")), sv(co.get("doenca_hepatica")),
-        sv(co.get("hbp")), sv(co.get("fa")), sv(co.get("outras")),
-        # IC
-        sv(ic.get("tipo_fe")), sv(ic.get("etiologia")),
-        sv(ic.get("feve_atual")), sv(ic.get("feve_trajetoria")),
-        # DRC
-        sv(drc.get("grau")), sv(drc.get("albuminuria")), sv(drc.get("etiologia")),
-        # Congestão + POCUS
-        sv(d.get("fenotipo_congestao")),
-        sv(poc.get("fe_pct")), sv(poc.get("ee_ratio")),
-        sv(poc.get("linhas_b_n")), sv(poc.get("vci_mm")),
-        # Medicação (12 classes × 3)
-        *med3("rasi"), *med3("mra"), *med3("isglt2"), *med3("glp1ra"),
-        *med3("estatina"), *med3("diuretico_ansa"), *med3("diuretico_tiazida"),
-        *med3("acetazolamida"), *med3("beta_bloqueante"),
-        *med3("antiagregante"), *med3("anticoagulante"), *med3("ivabradina"),
-        # Data
+        n_processo, sv(dob), sv(calculate_age(dob or "")),
+        *[sv(_get(extracted, p)) for p in _DOENTES_GETS],
         date.today().isoformat(),
     ]
 
 def build_visitas_row(n_processo: str, extracted: dict) -> list:
-    v  = extracted["visita"]
-    a  = v.get("analises", {})
-    s  = v.get("sintomas", {})
-    ef = v.get("exame_fisico", {})
-    return [
-        n_processo, sv(v.get("data_consulta")),
-        sv(a.get("ureia")), sv(a.get("creatinina")), sv(a.get("cistatina_c")),
-        sv(a.get("tfge_ckd_epi_crcist")),
-        sv(a.get("racu")), sv(a.get("rpc")), sv(a.get("na_urinario")),
-        sv(a.get("albumina")),
-        sv(a.get("alt")), sv(a.get("ast")), sv(a.get("ggt")), sv(a.get("bilirrubina_total")),
-        sv(a.get("na")), sv(a.get("k")), sv(a.get("cl")), sv(a.get("ca")),
-        sv(a.get("p")), sv(a.get("mg")),
-        sv(a.get("pth")), sv(a.get("vit_d")),
-        sv(a.get("nt_probnp")), sv(a.get("bnp")), sv(a.get("ca125")),
-        sv(a.get("hgb")), sv(a.get("leucocitos")), sv(a.get("plaquetas")),
-        sv(a.get("hco3")), sv(a.get("ca_ionizado")),
-        sv(a.get("sumario_urina")),
-        # Sintomas
-        sv(s.get("nyha")), sv(s.get("ccs")),
-        sv(s.get("ortopneia")), sv(s.get("bendopneia")), sv(s.get("edemas_mi")),
-        sv(s.get("claudicacao_intermitente")), sv(s.get("palpitacoes")),
-        # Exame físico
-        sv(ef.get("peso_kg")), sv(ef.get("altura_m")), sv(ef.get("imc")),
-        sv(ef.get("ta_sist")), sv(ef.get("ta_diast")), sv(ef.get("fc")), sv(ef.get("spo2")),
-    ]
+    return [n_processo, *[sv(_get(extracted, p)) for p in _VISITAS_GETS]]
 
 # ─── COMPONENTES UI ───────────────────────────────────────────────────────────
 def render_sidebar():
@@ -456,6 +814,9 @@ def render_sidebar():
         if sheet_id:
             url = f"https://docs.google.com/spreadsheets/d/{sheet_id}"
             st.link_button("📊 Abrir Google Sheet", url)
+        if st.button("🔄 Religar ao Google Sheets"):
+            reset_sheets_connection()
+            st.toast("Ligação ao Google Sheets reiniciada.")
 
 def render_review(extracted: dict):
     """Mostra resumo dos dados extraídos para revisão."""
@@ -469,56 +830,63 @@ def render_review(extracted: dict):
     s   = v.get("sintomas", {})
     ef  = v.get("exame_fisico", {})
 
-    col1, col2 = st.columns(2)
+    def lab(label, val, unit=""):
+        v_str = sv(val) or "—"
+        return f"**{label}:** {v_str}{' ' + unit if v_str != '—' and unit else ''}"
 
-    with col1:
-        st.markdown("#### 👤 Identificação")
-        st.write(f"**Data nasc.:** {sv(d.get('data_nascimento')) or '—'} &nbsp;|&nbsp; **Sexo:** {sv(d.get('sexo')) or '—'}")
-        st.write(f"**Localidade:** {sv(d.get('localidade')) or '—'} &nbsp;|&nbsp; **Profissão:** {sv(d.get('profissao')) or '—'}")
-        st.write(f"**Referenciação:** {sv(d.get('referenciacao')) or '—'} &nbsp;|&nbsp; **Frailty CFS:** {sv(d.get('frailty_cfs')) or '—'}")
+    # Um único bloco markdown por coluna (cada st.write é um elemento a mais no rerun)
+    left = [
+        "#### 👤 Identificação",
+        f"**Data nasc.:** {sv(d.get('data_nascimento')) or '—'} &nbsp;|&nbsp; **Sexo:** {sv(d.get('sexo')) or '—'}",
+        f"**Localidade:** {sv(d.get('localidade')) or '—'} &nbsp;|&nbsp; **Profissão:** {sv(d.get('profissao')) or '—'}",
+        f"**Referenciação:** {sv(d.get('referenciacao')) or '—'} &nbsp;|&nbsp; **Frailty CFS:** {sv(d.get('frailty_cfs')) or '—'}",
 
-        st.markdown("#### 🫀 Contexto Cardio-Renal")
-        st.write(f"**IC:** {sv(ic.get('tipo_fe')) or '—'} — {sv(ic.get('etiologia')) or '—'} | FEVE {sv(ic.get('feve_atual')) or '—'}% | {sv(ic.get('feve_trajetoria')) or '—'}")
-        st.write(f"**DRC:** {sv(drc.get('grau')) or '—'} {sv(drc.get('albuminuria')) or '—'} — {sv(drc.get('etiologia')) or '—'}")
-        st.write(f"**Congestão:** {sv(d.get('fenotipo_congestao')) or '—'}")
+        "#### 🫀 Contexto Cardio-Renal",
+        f"**IC:** {sv(ic.get('tipo_fe')) or '—'} — {sv(ic.get('etiologia')) or '—'} | FEVE {sv(ic.get('feve_atual')) or '—'}% | {sv(ic.get('feve_trajetoria')) or '—'}",
+        f"**DRC:** {sv(drc.get('grau')) or '—'} {sv(drc.get('albuminuria')) or '—'} — {sv(drc.get('etiologia')) or '—'}",
+        f"**Congestão:** {sv(d.get('fenotipo_congestao')) or '—'}",
 
-        st.markdown("#### 🔬 POCUS")
-        st.write(f"FE **{sv(poc.get('fe_pct')) or '—'}%** | E/E' **{sv(poc.get('ee_ratio')) or '—'}** | Linhas B **{sv(poc.get('linhas_b_n')) or '—'}** campos | VCI **{sv(poc.get('vci_mm')) or '—'} mm**")
+        "#### 🔬 POCUS",
+        f"FE **{sv(poc.get('fe_pct')) or '—'}%** | E/E' **{sv(poc.get('ee_ratio')) or '—'}** | Linhas B **{sv(poc.get('linhas_b_n')) or '—'}** campos | VCI **{sv(poc.get('vci_mm')) or '—'} mm**",
 
-        st.markdown("#### 🩺 Exame físico & Sintomas")
-        st.write(f"**NYHA:** {sv(s.get('nyha')) or '—'} | **CCS:** {sv(s.get('ccs')) or '—'}")
-        st.write(f"**Ortopneia:** {sv(s.get('ortopneia')) or '—'} | **Bendopneia:** {sv(s.get('bendopneia')) or '—'} | **Edemas MI:** {sv(s.get('edemas_mi')) or '—'}")
-        st.write(f"**Peso:** {sv(ef.get('peso_kg')) or '—'} kg | **IMC:** {sv(ef.get('imc')) or '—'}")
-        st.write(f"**TA:** {sv(ef.get('ta_sist')) or '—'}/{sv(ef.get('ta_diast')) or '—'} mmHg | **FC:** {sv(ef.get('fc')) or '—'} bpm | **SpO₂:** {sv(ef.get('spo2')) or '—'}%")
+        "#### 🩺 Exame físico & Sintomas",
+        f"**NYHA:** {sv(s.get('nyha')) or '—'} | **CCS:** {sv(s.get('ccs')) or '—'}",
+        f"**Ortopneia:** {sv(s.get('ortopneia')) or '—'} | **Bendopneia:** {sv(s.get('bendopneia')) or '—'} | **Edemas MI:** {sv(s.get('edemas_mi')) or '—'}",
+        f"**Peso:** {sv(ef.get('peso_kg')) or '—'} kg | **IMC:** {sv(ef.get('imc')) or '—'}",
+        f"**TA:** {sv(ef.get('ta_sist')) or '—'}/{sv(ef.get('ta_diast')) or '—'} mmHg | **FC:** {sv(ef.get('fc')) or '—'} bpm | **SpO₂:** {sv(ef.get('spo2')) or '—'}%",
+    ]
+
+    right = ["#### 💊 Medicação"]
+    for key, label in MED_LABELS.items():
+        m = med.get(key) or {}
+        if m.get("presente") is True:
+            farmaco = sv(m.get("farmaco")) or "—"
+            dose    = sv(m.get("dose")) or ""
+            right.append(f"✅ **{label}:** {farmaco} {dose}".strip())
+        elif m.get("presente") is False:
+            right.append(f"❌ **{label}**")
+        else:
+            right.append(f"❓ **{label}:** não identificado")
+
+    right += [
+        "#### 🧪 Análises (principais)",
+        lab("TFGe (CKD-EPI Cr-Cist)", a.get("tfge_ckd_epi_crcist"), "mL/min"),
+        lab("Creatinina", a.get("creatinina"), "mg/dL"),
+        lab("Cistatina C", a.get("cistatina_c"), "mg/L"),
+        lab("RACu", a.get("racu"), "mg/g"),
+        lab("NT-proBNP", a.get("nt_probnp"), "pg/mL"),
+        lab("K", a.get("k"), "mEq/L"),
+        lab("Na", a.get("na"), "mEq/L"),
+        lab("Hgb", a.get("hgb"), "g/dL"),
+        lab("Albumina", a.get("albumina"), "g/dL"),
+        lab("HCO₃⁻", a.get("hco3"), "mmol/L"),
+    ]
 
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("\n\n".join(left))
     with col2:
-        st.markdown("#### 💊 Medicação")
-        for key, label in MED_LABELS.items():
-            m = med.get(key) or {}
-            if m.get("presente") is True:
-                farmaco = sv(m.get("farmaco")) or "—"
-                dose    = sv(m.get("dose")) or ""
-                st.write(f"✅ **{label}:** {farmaco} {dose}".strip())
-            elif m.get("presente") is False:
-                st.write(f"❌ **{label}**")
-            else:
-                st.write(f"❓ **{label}:** não identificado")
-
-        st.markdown("#### 🧪 Análises (principais)")
-        def lab(label, val, unit=""):
-            v_str = sv(val) or "—"
-            st.write(f"**{label}:** {v_str}{' ' + unit if v_str != '—' and unit else ''}")
-
-        lab("TFGe (CKD-EPI Cr-Cist)", a.get("tfge_ckd_epi_crcist"), "mL/min")
-        lab("Creatinina", a.get("creatinina"), "mg/dL")
-        lab("Cistatina C", a.get("cistatina_c"), "mg/L")
-        lab("RACu", a.get("racu"), "mg/g")
-        lab("NT-proBNP", a.get("nt_probnp"), "pg/mL")
-        lab("K", a.get("k"), "mEq/L")
-        lab("Na", a.get("na"), "mEq/L")
-        lab("Hgb", a.get("hgb"), "g/dL")
-        lab("Albumina", a.get("albumina"), "g/dL")
-        lab("HCO₃⁻", a.get("hco3"), "mmol/L")
+        st.markdown("\n\n".join(right))
 
 # ─── MAIN ─────────────────────────────────────────────────────────────────────
 def main():
@@ -554,34 +922,59 @@ def main():
     # ── PROCESSARB────────────────────────────────────────────────────────────
     can_process = bool(n_processo and docx_file)
     if st.button("⚡ Processar Consulta", type="primary", disabled=not can_process):
-        texto_total = ""
+        warm_sheets_in_background()
 
-        with st.spinner("A extrair texto dos ficheiros…"):
-            try:
-                texto_total += parse_docx(docx_file.read())
-            except Exception as e:
-                st.error(f"Erro a ler o .docx: {e}")
-                return
-            if pdf_file:
+        # Ler os bytes aqui: os UploadedFile não devem ser usados noutras threads.
+        # getvalue() devolve o buffer do upload sem cópia e não depende da posição.
+        docx_bytes = docx_file.getvalue()
+        pdf_bytes  = pdf_file.getvalue() if pdf_file else None
+        cache_key  = ExtractionCache.key(docx_bytes, pdf_bytes)
+        extracted  = EXTRACTION_CACHE.get(cache_key)
+
+        if extracted is None:
+            texto_total = ""
+            pdf_ok = True
+
+            with st.spinner("A extrair texto dos ficheiros…"):
+                with ThreadPoolExecutor(max_workers=2) as ex:
+                    f_docx = ex.submit(parse_docx, docx_bytes)
+                    f_pdf  = ex.submit(parse_pdf, pdf_bytes) if pdf_bytes is not None else None
+                    try:
+                        texto_total += f_docx.result()
+                    except Exception as e:
+                        st.error(f"Erro a ler o .docx: {e}")
+                        return
+                    if f_pdf is not None:
+                        try:
+                            texto_total += "\n\n=== ANÁLISES LABORATORIAIS ===\n"
+                            texto_total += f_pdf.result()
+                        except Exception as e:
+                            pdf_ok = False
+                            st.warning(f"Não foi possível ler o PDF das análises: {e}")
+
+            with st.spinner("A enviar para o Gemini e a extrair dados estruturados…"):
                 try:
-                    texto_total += "\n\n=== ANÁLISES LABORATORIAIS ===\n"
-                    texto_total += parse_pdf(pdf_file.read())
+                    extracted = extract_with_gemini(texto_total)
+                except json.JSONDecodeError as e:
+                    st.error(f"O Gemini devolveu uma resposta que não é JSON válido: {e}")
+                    return
                 except Exception as e:
-                    st.warning(f"Não foi possível ler o PDF das análises: {e}")
+                    st.error(f"Erro na extração: {e}")
+                    return
+            # Sem as análises a extração é parcial: não a reutilizar para estes ficheiros
+            if pdf_ok:
+                EXTRACTION_CACHE.put(cache_key, extracted)
+        else:
+            st.info(
+                "Estes ficheiros já tinham sido processados — a usar a extração guardada. "
+                "Clica **Cancelar** para a descartar e voltar a processar."
+            )
 
-        with st.spinner("A enviar para o Gemini e a extrair dados estruturados…"):
-            try:
-                extracted = extract_with_gemini(texto_total)
-                st.session_state["extracted"]   = extracted
-                st.session_state["n_processo"]  = n_processo
-                st.session_state["ready_to_save"] = True
-                st.success("✅ Extração concluída! Revê os dados abaixo antes de guardar.")
-            except json.JSONDecodeError as e:
-                st.error(f"O Gemini devolveu uma resposta que não é JSON válido: {e}")
-                return
-            except Exception as e:
-                st.error(f"Erro na extração: {e}")
-                return
+        st.session_state["extracted"]   = extracted
+        st.session_state["n_processo"]  = n_processo
+        st.session_state["cache_key"]   = cache_key
+        st.session_state["ready_to_save"] = True
+        st.success("✅ Extração concluída! Revê os dados abaixo antes de guardar.")
 
     # ── REVISÃO & GUARDAR ────────────────────────────────────────────────────
     if st.session_state.get("ready_to_save") and "extracted" in st.session_state:
@@ -604,13 +997,14 @@ def main():
             if st.button("💾 Guardar no Google Sheets", type="primary"):
                 with st.spinner("A guardar…"):
                     try:
-                        ss = get_spreadsheet()
-                        ws_d = get_or_create_sheet(ss, SHEET_DOENTES, HEADERS_DOENTES)
-                        ws_v = get_or_create_sheet(ss, SHEET_VISITAS, HEADERS_VISITAS)
-                        ws_e = get_or_create_sheet(ss, SHEET_EVENTOS, HEADERS_EVENTOS)
+                        ss = get_spreadsheet(st.secrets["spreadsheet_id"])
+                        ws_d, ws_v, _ = get_worksheets(st.secrets["spreadsheet_id"])
 
-                        update_doentes_sheet(ws_d, n_processo, build_doentes_row(n_processo, extracted))
-                        ws_v.append_row(build_visitas_row(n_processo, extracted))
+                        save_consulta(
+                            ss, ws_d, ws_v, n_processo,
+                            build_doentes_row(n_processo, extracted),
+                            build_visitas_row(n_processo, extracted),
+                        )
 
                         st.success(f"✅ Dados do processo **{n_processo}** guardados com sucesso!")
                         st.balloons()
@@ -622,6 +1016,11 @@ def main():
             if st.button("🗑️ Cancelar"):
                 st.session_state["ready_to_save"] = False
                 st.session_state.pop("extracted", None)
+                # Extração rejeitada: o próximo Processar volta a chamar o modelo
+                cache_key = st.session_state.pop("cache_key", None)
+                if cache_key:
+                    EXTRACTION_CACHE.delete(cache_key)
+                _doentes_index.clear()
                 st.rerun()
 
 